@@ -1,8 +1,86 @@
+import math
 import numpy as np
 import control
 import scipy
 import matplotlib.pyplot as plt
 
+try:
+  import numba
+except ImportError:
+  numba = None
+
+
+def njit(**kwargs):
+  """
+  Compile a sim kernel with numba.njit(**kwargs). numba is optional, without
+  it the kernel runs as plain python. Caching needs a source file, so code
+  without one (e.g. run through exec) is compiled uncached.
+  """
+  def decorate(f):
+    if numba is None:
+      return f
+    try:
+      return numba.njit(**kwargs)(f)
+    except RuntimeError:
+      if not kwargs.get('cache'):
+        raise
+      return numba.njit(**dict(kwargs, cache=False))(f)
+  return decorate
+
+
+@njit(cache=True, fastmath=True)
+def _exp_coeffs(theta, s, c):
+  """
+  Coefficients A = sin(theta)/theta and B = (1 - cos(theta))/theta of the
+  SE2 exponential map, given s = sin(theta) and c = cos(theta). Near zero
+  their Taylor series is used, which avoids the cancellation in 1 - cos(theta)
+  and is exact to double precision for |theta| < 1e-2.
+  """
+  if abs(theta) < 1e-2:
+    A = 1 - theta**2/6 + theta**4/120
+    B = theta/2 - theta**3/24 + theta**5/720
+  else:
+    A = s/theta
+    B = (1 - c)/theta
+  return A, B
+
+
+@njit(cache=True, fastmath=True)
+def _wrap_angle(theta):
+  """
+  Wrap an angle in (-3pi, 3pi], such as a sum or difference of two wrapped
+  angles, into (-pi, pi] like to_params.
+  """
+  if theta > math.pi:
+    theta -= 2*math.pi
+  elif theta <= -math.pi:
+    theta += 2*math.pi
+  return theta
+
+
+@njit(cache=True, fastmath=True)
+def _pose(theta, x, y):
+  """
+  Pose of an SE2 element as a (theta, x, y, sin_t, cos_t) tuple, with the sin
+  and cos of theta computed once. This is the form the sim kernels work on.
+  """
+  return (theta, x, y, math.sin(theta), math.cos(theta))
+
+
+@njit(cache=True, fastmath=True)
+def _pose_compose(a, b):
+  """
+  Group product a*b of two poses, see _pose; b may also be a row of an
+  array. The angle is kept in (-pi, pi], its sin and cos follow from the
+  angle addition identities so no trig functions are evaluated.
+  """
+  return (
+      _wrap_angle(a[0] + b[0]),
+      a[1] + a[4]*b[1] - a[3]*b[2],
+      a[2] + a[3]*b[1] + a[4]*b[2],
+      a[3]*b[4] + a[4]*b[3],
+      a[4]*b[4] - a[3]*b[3])
+
 
 class SE2:
   """
@@ -14,6 +92,36 @@ class SE2:
   @see http://ethaneade.com/lie.pdf
   @see https://www.youtube.com/watch?v=mJ8ZDdA10GY
   """
+
+  def __init__(self):
+    # templates with the constant last row already filled in, new matrices
+    # are copies of these so no python lists are converted to arrays
+    self._M = np.eye(3)
+    self._Omega = np.zeros((3, 3))
+
+  def _group(self, c, s, x, y):
+    """
+    Group element from the cos and sin of its angle and its translation.
+    """
+    M = self._M.copy()
+    M[0, 0] = c
+    M[0, 1] = -s
+    M[0, 2] = x
+    M[1, 0] = s
+    M[1, 1] = c
+    M[1, 2] = y
+    return M
+
+  def _algebra(self, theta, x, y):
+    """
+    Lie algebra element from its parameters.
+    """
+    Omega = self._Omega.copy()
+    Omega[0, 1] = -theta
+    Omega[0, 2] = x
+    Omega[1, 0] = theta
+    Omega[1, 2] = y
+    return Omega
   
   def from_params(self, v):
     """`
@@ -21,21 +129,34 @@ class SE2:
     v: [theta, x, y]
     """
     theta, x, y = v
-    return np.array([
-        [np.cos(theta), -np.sin(theta), x],
-        [np.sin(theta), np.cos(theta), y],
-        [0, 0, 1]
-    ])
+    return self._group(math.cos(theta), math.sin(theta), x, y)
 
   def to_params(self, G):
     """
     Get parameterization of group.
     v = [theta, x, y]
     """
-    theta = np.arctan2(G[1, 0], G[0, 0])
+    return np.array(self.to_params_tuple(G))
+
+  def to_params_tuple(self, G):
+    """
+    to_params as a plain (theta, x, y) tuple, for callers that unpack it
+    right away.
+    """
+    theta = math.atan2(G[1, 0], G[0, 0])
     x = G[0, 2]
     y = G[1, 2]
-    return np.array([theta, x, y])
+    return theta, x, y
+
+  def inv(self, G):
+    """
+    Closed form inverse of a group element, [R, t]^-1 = [R^T, -R^T t].
+    """
+    c = G[0, 0]
+    s = G[1, 0]
+    tx = G[0, 2]
+    ty = G[1, 2]
+    return self._group(c, -s, -c*tx - s*ty, s*tx - c*ty)
   
   def wedge(self, v):
     """
@@ -49,11 +170,7 @@ class SE2:
     @return The 3x3 matrix in the lie algebra
     """
     dtheta, dx, dy = v
-    return np.array([
-        [0, -dtheta, dx],
-        [dtheta, 0, dy],
-        [0, 0, 0]
-        ])
+    return self._algebra(dtheta, dx, dy)
   
   def vee(self, Omega):
     """
@@ -63,10 +180,17 @@ class SE2:
     @param Omega: element of lie algebra
     @return vector in R^3
     """
+    return np.array(self.vee_tuple(Omega))
+
+  def vee_tuple(self, Omega):
+    """
+    vee as a plain (theta, x, y) tuple, for callers that unpack it right
+    away.
+    """
     theta = Omega[1, 0]
     x = Omega[0, 2]
     y = Omega[1, 2]
-    return np.array([theta, x, y])
+    return theta, x, y
  
   def exp(self, Omega):
     """
@@ -74,41 +198,28 @@ class SE2:
     se2 to the lie group SE2
     """
     theta = Omega[1, 0]
-    u = np.array([Omega[0, 2], Omega[1, 2]])
-    if np.abs(theta) < 1e-5:
-      A = 1
-      B = 0
-    else:
-      A = np.sin(theta)/theta
-      B = (1 - np.cos(theta))/theta
-    V = np.array([[A, -B], [B, A]])
-    p = V.dot(u)
-    return np.array([
-        [np.cos(theta), -np.sin(theta), p[0]],
-        [np.sin(theta), np.cos(theta), p[1]],
-        [0, 0, 1]
-    ])
+    u0 = Omega[0, 2]
+    u1 = Omega[1, 2]
+    s = math.sin(theta)
+    c = math.cos(theta)
+    A, B = _exp_coeffs(theta, s, c)
+    # p = V u with V = [[A, -B], [B, A]]
+    p0 = A*u0 - B*u1
+    p1 = B*u0 + A*u1
+    return self._group(c, s, p0, p1)
   
   def log(self, G):
     """
     The is the log map that transforms an element in the lie group SE2 to the
     lie algebra se2
     """
-    theta = np.arctan2(G[1, 0], G[0, 0])
-    if np.abs(theta) < 1e-5:
-      A = 1
-      B = 0
-    else:
-      A = np.sin(theta)/theta
-      B = (1 - np.cos(theta))/theta
-    V_I = np.array([[A, B], [-B, A]])/(A**2 + B**2)
-    p = np.array([G[0, 2], G[1, 2]])
-    u = V_I.dot(p)
-    return np.array([
-        [0, -theta, u[0]],
-        [theta, 0, u[1]],
-        [0, 0, 0]
-    ])
+    theta = math.atan2(G[1, 0], G[0, 0])
+    A, B = _exp_coeffs(theta, math.sin(theta), math.cos(theta))
+    # u = V^-1 p with V^-1 = [[A, B], [-B, A]]/(A^2 + B^2)
+    inv_det = 1/(A**2 + B**2)
+    u0 = inv_det*(A*G[0, 2] + B*G[1, 2])
+    u1 = inv_det*(-B*G[0, 2] + A*G[1, 2])
+    return self._algebra(theta, u0, u1)
 
 
 def test_SE2():
@@ -119,10 +230,163 @@ def test_SE2():
   v = np.array([1, 2, 3])
   assert np.allclose(G.vee(G.wedge(v)), v)
   assert np.allclose(G.vee(G.log(G.exp(G.wedge(v)))), v)
+  for theta in [1e-3, -5e-3, 2e-2]:
+    A, B = _exp_coeffs(theta, np.sin(theta), np.cos(theta))
+    assert np.isclose(A, np.sin(theta)/theta, rtol=1e-12)
+    assert np.isclose(B, 2*np.sin(theta/2)**2/theta, rtol=1e-12)
   assert np.allclose(G.to_params(G.from_params(v)), v)
+  assert np.allclose(G.to_params_tuple(G.from_params(v)), v)
+  assert np.allclose(G.vee_tuple(G.wedge(v)), v)
+  assert np.allclose(G.inv(G.from_params(v)), np.linalg.inv(G.from_params(v)))
+  a = _pose(1.0, 2.0, 3.0)
+  b = _pose(-3.0, 0.5, -1.0)
+  ab = _pose_compose(a, b)
+  Ga = G.from_params(a[:3])
+  Gb = G.from_params(b[:3])
+  assert np.allclose(G.from_params(ab[:3]), Ga.dot(Gb))
+  assert np.allclose(ab[3:], [np.sin(ab[0]), np.cos(ab[0])])
+  assert np.isclose(_pose_compose(_pose(3.0, 0.0, 0.0), _pose(1.0, 0.0, 0.0))[0],
+                    4 - 2*np.pi)
   
 test_SE2()
 
+
+# Sim kernels, compiled with numba when it is available. Poses are
+# (theta, x, y, sin_t, cos_t) tuples, see _pose.
+
+@njit(cache=True, fastmath=True)
+def _pose_exp(dtheta, dx, dy):
+  """
+  Kernel form of SE2.exp, taking the lie algebra parameters.
+  """
+  s = math.sin(dtheta)
+  c = math.cos(dtheta)
+  A, B = _exp_coeffs(dtheta, s, c)
+  return (dtheta, A*dx - B*dy, B*dx + A*dy, s, c)
+
+
+@njit(cache=True, fastmath=True)
+def _pose_error(a, b):
+  """
+  Parameters of log(a^-1 b), the error of pose b relative to pose a.
+  """
+  theta = _wrap_angle(b[0] - a[0])
+  px = a[4]*(b[1] - a[1]) + a[3]*(b[2] - a[2])
+  py = -a[3]*(b[1] - a[1]) + a[4]*(b[2] - a[2])
+  A, B = _exp_coeffs(theta, math.sin(theta), math.cos(theta))
+  det = A**2 + B**2
+  return (theta, (A*px + B*py)/det, (-B*px + A*py)/det)
+
+
+@njit(cache=True, fastmath=True)
+def _sim_reference_step(Xr, X, distance, crashed, noise, params, leg_bounds,
+                        u_ref, ref_steps):
+  """
+  Part of a sim step before the controller is called: compute the error,
+  then advance the reference trajectory.
+
+  noise: noise added to the error this step
+  params: (dt, width, crash_distance, track_length, desired_speed)
+  leg_bounds: distance along the lap at the end of each track leg
+  u_ref: reference velocity [omega, 0, v] of each track leg, the last row is
+    standing still
+  ref_steps: pose increment exp(u_ref*dt) of each row of u_ref
+  """
+  dt, width, crash_distance, track_length, desired_speed = params
+
+  # compute error and control
+  e_theta, e_x, e_y = _pose_error(Xr, X)
+
+  # check if you ran off the track
+  off_track = abs(e_x) > width
+
+  # check if you are way off track
+  if abs(e_x) > crash_distance:
+    crashed = True
+
+  # reference trajectory, the race course
+  i_leg = len(u_ref) - 1
+  if e_y > 0:
+    i_leg = np.searchsorted(leg_bounds, distance % track_length, side='right')
+    distance += desired_speed*dt
+  u_r = (u_ref[i_leg, 0], u_ref[i_leg, 1], u_ref[i_leg, 2])
+
+  # add noise
+  error = (e_theta + noise, e_x + noise, e_y + noise)
+
+  Xr = _pose_compose(Xr, ref_steps[i_leg])
+  return Xr, distance, crashed, off_track, error, u_r
+
+
+@njit(cache=True, fastmath=True)
+def _sim_vehicle_step(X, throttle, steering, crashed, off_track, dist, params):
+  """
+  Part of a sim step after the controller is called: update the actuators and
+  integrate the vehicle trajectory.
+
+  dist: disturbance waveform this step, scaled by velocity here
+  params: (dt, wheelbase, off_track_velocity_penalty, disturbance_mag_x,
+    disturbance_mag_theta)
+  """
+  dt, wheelbase, penalty, disturbance_mag_x, disturbance_mag_theta = params
+
+  # update actuators
+  throttle = min(max(throttle, 0.0), 1.0)
+  steering = min(max(steering, -1.0), 1.0)
+  wheel = steering
+  velocity = throttle
+
+  if crashed:
+    velocity = 0.0
+  elif off_track:
+    velocity = (1 - penalty)*velocity
+
+  # simulate disturbance in body frame
+  dist = dist*velocity
+  disturbance_x = dist*disturbance_mag_x
+  disturbance_theta = dist*disturbance_mag_theta
+
+  # integrate trajectory
+  dtheta = velocity*math.tan(wheel)/wheelbase + disturbance_theta
+  X = _pose_compose(X, _pose_exp(dtheta*dt, disturbance_x*dt, velocity*dt))
+  return X, throttle, steering, wheel, velocity
+
+
+@njit(cache=True, fastmath=True)
+def _dss_update(A, B, C, D, x, u):
+  """
+  Kernel of DiscreteStateSpace.update.
+  """
+  x = np.dot(A, x) + np.dot(B, u)
+  return x, np.dot(C, x) + np.dot(D, u)
+
+
+@njit(cache=True, fastmath=True)
+def _dss_update_small(A, B, C, D, x, u):
+  """
+  Kernel of DiscreteStateSpace.update with explicit loops, for a few states
+  this is faster than calling into BLAS.
+  """
+  n, m = B.shape
+  x_next = np.empty((n, 1))
+  for i in range(n):
+    acc = 0.0
+    for j in range(n):
+      acc += A[i, j]*x[j, 0]
+    for j in range(m):
+      acc += B[i, j]*u[j, 0]
+    x_next[i, 0] = acc
+  y = np.empty((C.shape[0], 1))
+  for i in range(C.shape[0]):
+    acc = 0.0
+    for j in range(n):
+      acc += C[i, j]*x_next[j, 0]
+    for j in range(m):
+      acc += D[i, j]*u[j, 0]
+    y[i, 0] = acc
+  return x_next, y
+
+
 class Sim:
   
   def __init__(self, Controller):
@@ -130,27 +394,27 @@ class Sim:
     Setup the sim and load the controller.
     """
     self.G = SE2()
-    self.data = {
-        't': [],
-        'theta': [],
-        'x': [],
-        'y': [],
-        'theta_r': [],
-        'x_r': [],
-        'y_r': [],
-        'throttle': [],
-        'velocity': [],
-        'steering': [],
-        'wheel': [],
-        'e_theta': [],
-        'e_x': [],
-        'e_y': [],
-        'track_left_x': [],
-        'track_left_y': [],
-        'track_right_x': [],
-        'track_right_y': [],
-        'off_track': [],
-    }
+    self.data = np.zeros(0, dtype=[
+        ('t', 'f8'),
+        ('theta', 'f8'),
+        ('x', 'f8'),
+        ('y', 'f8'),
+        ('theta_r', 'f8'),
+        ('x_r', 'f8'),
+        ('y_r', 'f8'),
+        ('throttle', 'f8'),
+        ('velocity', 'f8'),
+        ('steering', 'f8'),
+        ('wheel', 'f8'),
+        ('e_theta', 'f8'),
+        ('e_x', 'f8'),
+        ('e_y', 'f8'),
+        ('track_left_x', 'f8'),
+        ('track_left_y', 'f8'),
+        ('track_right_x', 'f8'),
+        ('track_right_y', 'f8'),
+        ('off_track', '?'),
+    ])
     
     # you can turn on/off noise and disturbance here
     self.enable_noise = 1 # turn on noise (0 or 1)
@@ -170,6 +434,7 @@ class Sim:
     self.off_track_velocity_penalty = 0.5 # fraction of true velocity when off track [0-1]
     self.desired_speed = 2  # desired speed of reference point
     self.crash_distance = 0.2
+    self.seed = None # seed for noise and disturbance, None for a random run
     
     # setup controller
     self.controller = Controller(self.dt)
@@ -182,122 +447,92 @@ class Sim:
       print('sim started')
     
     # randomize noise and disturbance phase
-    phi_dist = 0.1*np.pi*np.random.randn()
-    phi_noise = 0.1*np.pi*np.random.randn()
+    rng = np.random.default_rng(self.seed)
+    phi_dist = 0.1*np.pi*rng.standard_normal()
+    phi_noise = 0.1*np.pi*rng.standard_normal()
+
+    # the time base, noise and disturbance are open loop, so precompute them
+    t_arr = np.arange(0, self.tf, self.dt)
+    n = len(t_arr)
+    noise_wave = self.enable_noise*self.noise_mag*np.sin(30*2*np.pi*t_arr + phi_noise)
+    dist_wave = self.enable_disturbance*(
+        0.2 + np.sin(3*t_arr*2*np.pi + phi_dist + rng.standard_normal(n)))
+
+    # reference trajectory, the race course
+    t_lap = self.track_length/self.desired_speed
+    leg_d = self.track_length/len(self.track)
+    leg_dt = leg_d/self.desired_speed
+
+    # preallocate data storage
+    self.data = np.zeros(n, dtype=self.data.dtype)
+
+    # only the reference x, y of the track edges are needed, they are filled
+    # in after the loop so the steps write every other field
+    data = self.data[[
+        name for name in self.data.dtype.names if not name.startswith('track_')]]
     
+    # reference velocity of each leg, the last row is standing still (and is
+    # also where a lap distance past the last leg bound lands); the reference
+    # moves by the same increment every step of a leg
+    leg_bounds = np.arange(1, len(self.track) + 1)*leg_d
+    u_ref = np.zeros((len(self.track) + 1, 3))
+    u_ref[:-1, 0] = np.array(self.track)*np.pi/2/leg_dt
+    u_ref[:-1, 2] = self.desired_speed
+    ref_steps = np.array([_pose_exp(w*self.dt, 0.0, v*self.dt) for w, _, v in u_ref])
+
+    # kernel parameters, fixed for the whole run
+    ref_params = (
+        float(self.dt), float(self.width), float(self.crash_distance),
+        float(self.track_length), float(self.desired_speed))
+    vehicle_params = (
+        float(self.dt), float(self.wheelbase),
+        float(self.off_track_velocity_penalty),
+        float(self.disturbance_mag_x), float(self.disturbance_mag_theta))
+
     # put the car at the starting line, facing the right direction
-    theta0 = 0
+    theta0 = 0.0
     x0 = self.width/2
-    y0 = 0
-    X = self.G.from_params([theta0, x0, y0])
-    Xr = self.G.from_params([theta0, 0, 0])
+    y0 = 0.0
+    X = _pose(theta0, x0, y0)
+    Xr = _pose(theta0, 0.0, 0.0)
 
     # start reference position as starting line
-    velocity = 0
-    distance = 0
+    velocity = 0.0
+    distance = 0.0
     crashed = False
     
-    for t in np.arange(0, self.tf, self.dt):
+    for k in range(n):
       
-      # compute error and control
-      theta_r, x_r, y_r = self.G.to_params(Xr)
-      theta, x, y = self.G.to_params(X)
-      Xr = self.G.from_params([theta_r, x_r, y_r])
-      track_left = Xr.dot(self.G.from_params([0, self.width, 0]))
-      track_right = Xr.dot(self.G.from_params([0, -self.width, 0]))
-      track_left_theta, track_left_x, track_left_y = self.G.to_params(track_left)
-      track_right_theta, track_right_x, track_right_y = self.G.to_params(track_right)
-
-      error = self.G.vee(self.G.log(np.linalg.inv(Xr).dot(X)))
-
-      # check if you ran off the track
-      if (np.abs(error[1])  > self.width):
-        off_track = True
-      else:
-        off_track = False
-
-      # check if you are way off track
-      if (np.abs(error[1]) > self.crash_distance):
-        crashed = True
-
-      # reference trajectory, the race course
-      t_lap = self.track_length/self.desired_speed
-      leg_d = self.track_length/len(self.track)
-      leg_dt = leg_d/self.desired_speed
-      u_r = np.array([0, 0, 0])
-      for i_leg, turn in enumerate(self.track):
-        d_lap = distance % self.track_length
-        if d_lap < (i_leg + 1)*leg_d:
-          u_r = np.array([self.track[i_leg]*np.pi/2/leg_dt, 0, self.desired_speed])
-          break
-      if error[2] > 0:
-        distance += self.desired_speed*self.dt
-      else:
-        u_r = np.array([0, 0, 0])
-
-      # add noise
-      error += self.enable_noise*self.noise_mag*(np.sin(30*2*np.pi*t + phi_noise))*velocity
-
-      dXr = self.G.exp(self.G.wedge(u_r*self.dt))
-      Xr = Xr.dot(dXr)
+      theta_r, x_r, y_r = Xr[:3]
+      theta, x, y = X[:3]
+
+      # compute error, then advance the reference trajectory
+      noise = noise_wave[k]*velocity
+      Xr, distance, crashed, off_track, error, u_r = _sim_reference_step(
+          Xr, X, distance, crashed, noise, ref_params, leg_bounds, u_ref,
+          ref_steps)
 
       # call the controller
-      throttle, steering = self.controller.update(error, u_r)
-
-      # update actuators
-      if throttle < 0:
-        throttle = 0
-      elif throttle > 1:
-        throttle = 1
-      if steering > 1:
-        steering = 1
-      elif steering < -1:
-        steering = -1
-      wheel = steering
-      velocity = throttle
-
-      if crashed:
-        velocity = 0
-      elif off_track:
-        velocity = (1-self.off_track_velocity_penalty)*velocity
-        
-      # simulate disturbance in body frame
-      dist = self.enable_disturbance*(0.2 + np.sin(3*t*2*np.pi + phi_dist + np.random.randn()))*velocity
-      disturbance_x = dist*self.disturbance_mag_x
-      disturbance_theta = dist*self.disturbance_mag_theta
-      
-      # integrate trajectory
-      dtheta = velocity*np.tan(wheel)/self.wheelbase + disturbance_theta
-      dx = disturbance_x
-      dy = velocity
-      u = np.array([dtheta, dx, dy])
-      dX = self.G.exp(self.G.wedge(u*self.dt))
-      X = X.dot(dX)
-
-      # store data
-      self.data['t'].append(t)
-      self.data['theta'].append(theta)
-      self.data['x'].append(x)
-      self.data['y'].append(y)
-      self.data['theta_r'].append(theta_r)
-      self.data['x_r'].append(x_r)
-      self.data['y_r'].append(y_r)
-      self.data['throttle'].append(throttle)
-      self.data['steering'].append(steering)
-      self.data['velocity'].append(velocity)
-      self.data['wheel'].append(wheel)
-      self.data['e_theta'].append(error[0])
-      self.data['e_x'].append(error[1])
-      self.data['e_y'].append(error[2])
-      self.data['track_left_x'].append(track_left_x)
-      self.data['track_left_y'].append(track_left_y)
-      self.data['track_right_x'].append(track_right_x)
-      self.data['track_right_y'].append(track_right_y)
-      self.data['off_track'].append(off_track)
-
-    # convert lists to numpy array for faster plotting
-    for k in self.data.keys():
-      self.data[k] = np.array(self.data[k])
+      throttle, steering = self.controller.update(np.array(error), np.array(u_r))
+
+      # update actuators and integrate trajectory
+      X, throttle, steering, wheel, velocity = _sim_vehicle_step(
+          X, float(np.squeeze(throttle)), float(np.squeeze(steering)),
+          crashed, off_track, dist_wave[k],
+          vehicle_params)
+
+      # store data, one row per step in the field order of self.data
+      data[k] = (
+          t_arr[k], theta, x, y, theta_r, x_r, y_r, throttle, velocity,
+          steering, wheel, error[0], error[1], error[2], off_track)
+
+    # track edges, offset by the width along the reference x axis
+    cos_r = np.cos(self.data['theta_r'])
+    sin_r = np.sin(self.data['theta_r'])
+    self.data['track_left_x'] = self.data['x_r'] + cos_r*self.width
+    self.data['track_left_y'] = self.data['y_r'] + sin_r*self.width
+    self.data['track_right_x'] = self.data['x_r'] - cos_r*self.width
+    self.data['track_right_y'] = self.data['y_r'] - sin_r*self.width
  
     if self.verbose:
       print('sim complete')
@@ -306,84 +541,142 @@ class Sim:
     return distance
  
   def plot(self):
-    theta = np.linspace(0, 2*np.pi, 1000)
-    plt.figure(figsize=(10, 10))
-    plt.plot(self.data['track_left_x'], self.data['track_left_y'], 'g-', label='track', linewidth=3, alpha=0.5)
-    plt.plot(self.data['track_right_x'], self.data['track_right_y'], 'g-', linewidth=3, alpha=0.5)
-    plt.plot(self.data['x_r'], self.data['y_r'], 'r-', label='reference', linewidth=3, alpha=0.5)
-    plt.plot(self.data['x'], self.data['y'], 'b', label='vehicle')
-    plt.legend()
-    plt.axis('equal')
-    plt.title('track')
-    plt.xlabel('East')
-    plt.ylabel('North')
-    plt.grid()
-
-    plt.figure(figsize=(10, 30))
-    n = 3
-    plt.subplot(n, 1, 1)
-    plt.plot(self.data['t'], self.data['e_x'], label='e_x')
-    plt.xlabel('t, sec')
-    plt.ylabel('m')
-    plt.legend()
-    plt.title('cross track error')
-    plt.grid()
-
-    plt.subplot(n, 1, 2)
-    plt.plot(self.data['t'], self.data['e_y'], label='e_y')
-    plt.legend()
-    plt.xlabel('t, sec')
-    plt.ylabel('m')
-    plt.title('along track error')
-    plt.grid()
-
-    plt.subplot(n, 1, 3)
-    plt.plot(self.data['t'], np.rad2deg(self.data['e_theta']), label='e_theta')
-    plt.legend()
-    plt.xlabel('t, sec')
-    plt.ylabel('deg')
-    plt.title('angle error')
-    plt.grid()
-
-    plt.figure(figsize=(10, 20))
-    n = 2
-    plt.subplot(n, 1, 1)
-    plt.plot(self.data['t'], self.data['throttle'], label='command')
-    plt.plot(self.data['t'], self.data['velocity'], label='velocity')
-    plt.legend()
-    plt.xlabel('t, sec')
-    plt.ylabel('velocity, m/s')
-    plt.title('velocity')
-    plt.grid()
-
-    plt.subplot(n, 1, 2)
-    plt.plot(self.data['t'], np.rad2deg(self.data['steering']), label='command')
-    plt.plot(self.data['t'], np.rad2deg(self.data['wheel']), label='wheel')
-    plt.legend()
-    plt.xlabel('t, sec')
-    plt.ylabel('angle, deg')
-    plt.title('steering')
-    plt.grid()
+    # about 1000 points per line look the same as the full run and draw much
+    # faster, lines are rasterized to keep saved vector figures small
+    stride = max(1, len(self.data) // 1000)
+    data = self.data[::stride]
+
+    fig, ax = plt.subplots(figsize=(10, 10))
+    ax.plot(data['track_left_x'], data['track_left_y'], 'g-', label='track', linewidth=3, alpha=0.5, rasterized=True)
+    ax.plot(data['track_right_x'], data['track_right_y'], 'g-', linewidth=3, alpha=0.5, rasterized=True)
+    ax.plot(data['x_r'], data['y_r'], 'r-', label='reference', linewidth=3, alpha=0.5, rasterized=True)
+    ax.plot(data['x'], data['y'], 'b', label='vehicle', rasterized=True)
+    ax.legend()
+    ax.axis('equal')
+    ax.set_title('track')
+    ax.set_xlabel('East')
+    ax.set_ylabel('North')
+    ax.grid()
+
+    fig, axes = plt.subplots(3, 1, figsize=(10, 30))
+    ax = axes[0]
+    ax.plot(data['t'], data['e_x'], label='e_x', rasterized=True)
+    ax.set_xlabel('t, sec')
+    ax.set_ylabel('m')
+    ax.legend()
+    ax.set_title('cross track error')
+    ax.grid()
+
+    ax = axes[1]
+    ax.plot(data['t'], data['e_y'], label='e_y', rasterized=True)
+    ax.legend()
+    ax.set_xlabel('t, sec')
+    ax.set_ylabel('m')
+    ax.set_title('along track error')
+    ax.grid()
+
+    ax = axes[2]
+    ax.plot(data['t'], np.rad2deg(data['e_theta']), label='e_theta', rasterized=True)
+    ax.legend()
+    ax.set_xlabel('t, sec')
+    ax.set_ylabel('deg')
+    ax.set_title('angle error')
+    ax.grid()
+
+    fig, axes = plt.subplots(2, 1, figsize=(10, 20))
+    ax = axes[0]
+    ax.plot(data['t'], data['throttle'], label='command', rasterized=True)
+    ax.plot(data['t'], data['velocity'], label='velocity', rasterized=True)
+    ax.legend()
+    ax.set_xlabel('t, sec')
+    ax.set_ylabel('velocity, m/s')
+    ax.set_title('velocity')
+    ax.grid()
+
+    ax = axes[1]
+    ax.plot(data['t'], np.rad2deg(data['steering']), label='command', rasterized=True)
+    ax.plot(data['t'], np.rad2deg(data['wheel']), label='wheel', rasterized=True)
+    ax.legend()
+    ax.set_xlabel('t, sec')
+    ax.set_ylabel('angle, deg')
+    ax.set_title('steering')
+    ax.grid()
+
+
+# discretized (A, B, C, D, dt) of transfer functions, keyed by coefficients
+# and dt, so rebuilding a controller does not repeat c2d and tf2ss
+_discretized = {}
+
+
+def _discretize(H, dt):
+  """
+  Discrete state space matrices of the continuous system H, any LTI system
+  python-control accepts. Only transfer functions are cached.
+  """
+  if not isinstance(H, control.TransferFunction):
+    sys = control.tf2ss(control.c2d(H, dt))
+    return sys.A, sys.B, sys.C, sys.D, sys.dt
+  key = (
+      tuple(tuple(np.ravel(p)) for row in H.num for p in row),
+      tuple(tuple(np.ravel(p)) for row in H.den for p in row),
+      dt)
+  if key not in _discretized:
+    sys = control.tf2ss(control.c2d(H, dt))
+    _discretized[key] = tuple(
+        np.ascontiguousarray(M, dtype=np.float64)
+        for M in (sys.A, sys.B, sys.C, sys.D)) + (sys.dt,)
+  return _discretized[key]
 
 
 class DiscreteStateSpace:
   """
   Use this class to implement any controller you need.
-  It takes a continuous time transfer function.
+  It takes a continuous time transfer function, or an already discrete
+  system as a tuple (A, B, C, D, dt).
   """
   
-  def __init__(self, H, dt):
-    sys = control.tf2ss(control.c2d(H, dt))
-    self.x = np.zeros((sys.A.shape[0], 1))
-    self.A = sys.A
-    self.B = sys.B
-    self.C = sys.C
-    self.D = sys.D
-    self.dt = sys.dt
+  def __init__(self, H, dt=None):
+    if isinstance(H, tuple):
+      A, B, C, D, dt = H
+    else:
+      A, B, C, D, dt = _discretize(H, dt)
+    # own copies, so tweaking one controller's matrices does not change the
+    # cache or the caller's arrays
+    A, B, C, D = (np.array(M, dtype=np.float64, order='C')
+                  for M in (A, B, C, D))
+    self.x = np.zeros((A.shape[0], 1))
+    self.A = A
+    self.B = B
+    self.C = C
+    self.D = D
+    self.dt = dt
+    self._kernel = _dss_update_small if A.shape[0] < 4 else _dss_update
 
   def update(self, u):
-    self.x = self.A.dot(self.x) + self.B.dot(u)
-    return self.C.dot(self.x) + self.D.dot(u)
+    u = np.ascontiguousarray(u, dtype=np.float64).reshape(-1, 1)
+    self.x, y = self._kernel(self.A, self.B, self.C, self.D, self.x, u)
+    return y
  
   def __repr__(self):
-    return repr(self.__dict__)
\ No newline at end of file
+    return repr(self.__dict__)
+
+
+def test_DiscreteStateSpace():
+  """
+  Make sure controllers built from the same system do not share matrices.
+  """
+  H = control.tf([1, 1], [1, 10])
+  a = DiscreteStateSpace(H, 0.01)
+  b = DiscreteStateSpace(H, 0.01)
+  c = DiscreteStateSpace((a.A, a.B, a.C, a.D, a.dt))
+  for M in ['A', 'B', 'C', 'D']:
+    assert not np.shares_memory(getattr(a, M), getattr(b, M))
+    assert not np.shares_memory(getattr(a, M), getattr(c, M))
+  a.D *= 2
+  assert np.allclose(DiscreteStateSpace(H, 0.01).D, b.D)
+  # any LTI system works, not only transfer functions
+  d = DiscreteStateSpace(control.tf2ss(H), 0.01)
+  for u in [1.0, -2.0, 0.5]:
+    assert np.allclose(d.update(u), b.update(u))
+
+test_DiscreteStateSpace()
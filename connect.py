@@ -1,47 +1,79 @@
 import asyncio
+import numpy as np
 import qtm
 from pynput import keyboard
 from rover import Rover
 from random import randint
 
 
-def on_packet(packet):
-    """ Callback function that is called everytime a data packet arrives from QTM """
-    print("Framenumber: {}".format(packet.framenumber))
-    header, markers = packet.get_3d_markers()
-    print("Component info: {}".format(header))
-    for marker in markers:
-        print("\t", marker)
+def make_on_packet(queue):
+    """ Build the callback that is called everytime a data packet arrives from QTM """
+    def on_packet(packet):
+        # parse the markers once and hand them off, printing is left to the
+        # logger task so the receive path is never blocked
+        header, markers = packet.get_3d_markers()
+        markers = np.array(markers, dtype=float).reshape(-1, 3)
+        try:
+            queue.put_nowait((packet.framenumber, header, markers))
+        except asyncio.QueueFull:
+            pass  # the logger is behind, drop this frame from the log
+    return on_packet
 
 
-async def setup(address):
+async def log_frames(queue):
+    """ Print the frames queued by on_packet """
+    while True:
+        framenumber, header, markers = await queue.get()
+        print("Framenumber: {}".format(framenumber))
+        print("Component info: {}".format(header))
+        for marker in markers:
+            print("\t", marker)
+
+
+async def drive_rover(abort):
+    """ Execute random movement sets on the rover until abort is set """
+    freenove = Rover()
+    loop = asyncio.get_running_loop()
+    try:
+        while not abort.is_set():
+            current_moveset = randint(0,3) #in the case that we have 4 movement set
+            # execute_path sleeps between motor commands, keep it off the event loop
+            await loop.run_in_executor(None, freenove.execute_path, current_moveset)
+    finally:
+        # also stop the motors when main is cancelled or fails, e.g. on Ctrl-C,
+        # this interrupts the movement set still running in the executor
+        freenove.stop()
+
+
+async def main(address):
     """ Main function """
     connection = await qtm.connect(address)
     if connection is None:
         return
 
-    await connection.stream_frames(components=["3d"], on_packet=on_packet)
+    loop = asyncio.get_running_loop()
+    abort = asyncio.Event()
+
+    def on_press(key):
+        if key == keyboard.Key.esc:
+            print("\nstoping the program, escaped is pressed")
+            loop.call_soon_threadsafe(abort.set)
+            return False
+
+    keyboard.Listener(on_press=on_press).start()
+
+    queue = asyncio.Queue(maxsize=100)
+    await connection.stream_frames(components=["3d"], on_packet=make_on_packet(queue))
+    logger = asyncio.ensure_future(log_frames(queue))
+    try:
+        await drive_rover(abort)
+    finally:
+        logger.cancel()
+        await connection.stream_frames_stop()
+        connection.disconnect()
 
 
 if __name__ == "__main__":
-    
-    address = str(input("enter QTM computer's address:"))
-    asyncio.ensure_future(setup(address))
-    asyncio.get_event_loop().run_forever()
-    
 
-    '''
-    freenove = Rover()
-    current_moveset = randint(0,3) #in the case that we have 4 movement set
-    iterations = 5 #in the case we want rover to execute 5 movement set
-    abort_flag = False
-    while abort_flag == False:
-        for index in range(iterations - 1):
-            freenove.execute_path(current_moveset)
-            current_moveset = randint(0,3)
-            if keyboard.is_pressed("esc"):
-                print("\nstoping the program, escaped is pressed")
-                abort_flag = True
-
-freenove.execute_path()       
-'''    
+    address = str(input("enter QTM computer's address:"))
+    asyncio.run(main(address))
@@ -1,10 +1,24 @@
 from Motor import Motor
+import threading
 import time
 class Rover:
     def __init__(self):
         self.state = "standby"
         self.motor = Motor()
-        self.speed.setMotorModel(0,0,0,0)
+        #movement sets, indexed by path_indicator. each one is a sequence of
+        #motor commands (left front, left back, right front, right back, seconds, state)
+        forward = (2000,2000,2000,2000,5,"moving")
+        left = (-500,-500,2000,2000,5,"rotating")
+        right = (2000,2000,-500,-500,5,"rotating")
+        halt = (0,0,0,0,2,"halting")
+        self._paths = [
+            (forward,left,halt,right,halt),
+            (forward,right,halt,left,halt),
+            (forward,halt),
+            (left,right,halt),
+        ]
+        self._stop = threading.Event()
+        self.motor.setMotorModel(0,0,0,0)
     def check_status(self):
         print("rover status:",self.state)
 
@@ -29,11 +43,24 @@ class Rover:
         time.sleep(interval)
     def halting(self,interval):
         self.state = 'halting'
-        Rover.move(0,interval)
+        self.motor.setMotorModel(0,0,0,0)
+        time.sleep(interval)
     
-    def execute_path(self):
-        Rover.move(2000,5)
-        Rover.rotate(False,2000,5)
-        Rover.halting(2)
-        Rover.rotate(True,)
+    def stop(self):
+        #stop the motors, also from another thread while execute_path runs
+        self._stop.set()
+        self.motor.setMotorModel(0,0,0,0)
+
+    def execute_path(self,path_indicator):
+        self._stop.clear()
+        _set = self.motor.setMotorModel
+        _wait = self._stop.wait
+        for command in self._paths[path_indicator]:
+            self.state = command[5]
+            _set(*command[:4])
+            if _wait(command[4]):
+                #stop() was called, undo the command that may have raced it
+                _set(0,0,0,0)
+                break
+        self.state = "standby"
     
\ No newline at end of file